@@ -35,6 +35,15 @@ def csv_list(s):
         return row
 
 
+def key_value(s):
+    """Parse a key=value string into a (key, value) tuple."""
+    key, sep, value = s.partition('=')
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(
+            "Unable to parse key=value pair, %s" % s)
+    return key, value
+
+
 def readable_dir(prospective_dir):
     if not os.path.isdir(prospective_dir):
         raise argparse.ArgumentTypeError(
@@ -1,6 +1,11 @@
+import json
+import sys
+import threading
+from Queue import Full, Queue
 from datetime import timedelta
 
 from django.conf import settings
+from django.db import connection
 
 
 def queryset_generator(queryset, chunksize=1000):
@@ -13,26 +18,158 @@ def queryset_generator(queryset, chunksize=1000):
     memory. Using the iterator() method only causes it to not preload all the
     classes.
 
+    Each chunk picks up after the last pk of the one before (WHERE pk > x
+    ORDER BY pk LIMIT chunksize), so the whole queryset is read in a single
+    pass over the pk index, without OFFSETs and without separate queries to
+    find the first and last pks. Any select_related or prefetch_related on
+    the queryset is applied to each chunk.
+
     Note that the implementation of the iterator does not support ordered query
     sets.
     """
     if settings.DEVELOPMENT:
         chunksize = 5
 
-    # Make a query that doesn't do related fetching for optimization
-    bare_qs = queryset.prefetch_related(None)
-    if bare_qs.count() == 0:
-        return
-    pk = bare_qs.order_by('pk')[0].pk
-    # Decrement pk for use with 'greater than' filter
-    if pk > 0:
-        pk -= 1
-    last_pk = bare_qs.order_by('-pk')[0].pk
-    queryset = bare_qs.order_by('pk')
-    while pk < last_pk:
-        for row in queryset.filter(pk__gt=pk)[:chunksize]:
+    queryset = queryset.order_by('pk')
+    pk = None
+    while True:
+        if pk is None:
+            chunk = queryset[:chunksize]
+        else:
+            chunk = queryset.filter(pk__gt=pk)[:chunksize]
+        row_count = 0
+        for row in chunk:
             pk = row.pk
+            row_count += 1
             yield row
+        if row_count < chunksize:
+            # A short chunk means we've reached the end.
+            return
+
+
+def pk_chunk_generator(queryset, chunksize=10000):
+    """Yield lists of up to chunksize pks from a queryset, in pk order.
+
+    Each chunk starts after the last pk of the one before, so only one chunk
+    is ever in memory and the database never has to skip over an OFFSET.
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        if last_pk is None:
+            chunk = list(pks[:chunksize])
+        else:
+            chunk = list(pks.filter(pk__gt=last_pk)[:chunksize])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def estimate_table_count(model):
+    """Get Postgres's estimate of the number of rows in a model's table.
+
+    This reads the planner statistics instead of doing a COUNT(*), which can
+    take minutes on big tables. Use it where a rough number is good enough,
+    like progress meters. Falls back to a real count if the table hasn't been
+    analyzed yet.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+            [model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    if row is None or row[0] <= 0:
+        return model.objects.count()
+    return row[0]
+
+
+def estimate_queryset_count(queryset):
+    """Get the planner's estimate of the number of rows a queryset returns.
+
+    Like estimate_table_count, but for filtered querysets. The estimate can be
+    well off, so only use it for display.
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+def prefetching_generator(items, chunksize=1000, max_chunks=2):
+    """Pull items from an iterator in a background thread, keeping up to
+    max_chunks chunks of chunksize items ready for the caller.
+
+    Use this to overlap database reads with whatever the caller does with the
+    items (e.g., waiting on Celery): while the caller works through one chunk,
+    the database is already fetching the next.
+
+    A separate thread gets a separate database connection, which cannot see
+    uncommitted rows. If the current connection is inside a transaction (as it
+    is in tests), items are instead iterated in the caller's thread.
+
+    If the caller stops early, the thread stops once its current chunk is
+    full, and closes its connection.
+    """
+    if connection.in_atomic_block:
+        for item in items:
+            yield item
+        return
+
+    queue = Queue(maxsize=max_chunks)
+    done = object()
+    # Set when the caller stops early (an error, Ctrl-C, or closing the
+    # generator), so the producer doesn't block forever on a full queue while
+    # holding its own database connection.
+    stopped = threading.Event()
+
+    def put(chunk):
+        """Put a chunk on the queue, giving up if the caller has stopped."""
+        while not stopped.is_set():
+            try:
+                queue.put(chunk, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        chunk = []
+        try:
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= chunksize:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if chunk:
+                put(chunk)
+        except Exception:
+            put(sys.exc_info())
+        finally:
+            connection.close()
+            put(done)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is done:
+                break
+            if isinstance(chunk, tuple):
+                # An exception was raised in the producer. Re-raise it here.
+                raise chunk[0], chunk[1], chunk[2]
+            for item in chunk:
+                yield item
+    finally:
+        stopped.set()
 
 
 def queryset_generator_by_date(queryset, date_field, start_date, end_date,
@@ -1,14 +1,57 @@
+from multiprocessing.pool import ThreadPool
+
+from requests.adapters import HTTPAdapter
 from scorched import SolrInterface
 from scorched.search import Options, SolrSearch
 
 
 class ExtraSolrInterface(SolrInterface):
     """Extends the SolrInterface class so that it uses the ExtraSolrSearch
-    class.
+    class, and so that it can send updates to Solr concurrently.
     """
+    # The most update requests that will be sent to Solr at once.
+    max_connections = 4
 
     def __init__(self, *args, **kwargs):
+        """Takes the same arguments as SolrInterface, plus max_retries, which
+        is passed to the requests HTTPAdapter (e.g., a urllib3 Retry object).
+        """
+        max_retries = kwargs.pop('max_retries', 0)
         super(ExtraSolrInterface, self).__init__(*args, **kwargs)
+        # Scorched ignores the http_connection argument and makes its own
+        # session. Give that session enough pooled connections that concurrent
+        # updates don't have to open new ones.
+        adapter = HTTPAdapter(pool_connections=self.max_connections,
+                              pool_maxsize=self.max_connections,
+                              max_retries=max_retries)
+        self.conn.http_connection.mount('http://', adapter)
+        self.conn.http_connection.mount('https://', adapter)
+
+    def add_concurrently(self, docs, chunk=100, **kwargs):
+        """Like add, but sends the chunks to Solr in parallel.
+
+        Solr can ingest several update requests at once, so rather than
+        waiting for each chunk's response before sending the next, this keeps
+        up to max_connections requests in flight.
+
+        :returns: list of SolrUpdateResponse -- One per chunk.
+        """
+        if hasattr(docs, "items") or not isinstance(docs, (tuple, list)):
+            docs = [docs]
+        chunks = [docs[i:i + chunk] for i in range(0, len(docs), chunk)]
+        if len(chunks) <= 1:
+            return self.add(docs, chunk=chunk, **kwargs)
+
+        pool = ThreadPool(min(len(chunks), self.max_connections))
+        try:
+            responses = pool.map(
+                lambda c: self.add(c, chunk=chunk, **kwargs),
+                chunks,
+            )
+        finally:
+            pool.close()
+            pool.join()
+        return [r for response in responses for r in response]
 
     def query(self, *args, **kwargs):
         """
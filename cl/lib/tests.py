@@ -2,13 +2,18 @@
 """
 Unit tests for lib
 """
+import argparse
 import datetime
+import threading
 
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test import override_settings
 from rest_framework.status import HTTP_503_SERVICE_UNAVAILABLE, HTTP_200_OK
 
+from cl.lib.argparse_types import key_value
+from cl.lib.db_tools import pk_chunk_generator, prefetching_generator, \
+    queryset_generator
 from cl.lib.mime_types import lookup_mime_type
 from cl.lib.model_helpers import make_upload_path
 from cl.lib.search_utils import make_fq
@@ -59,6 +64,151 @@ class TestStringUtils(TestCase):
             )
 
 
+class TestArgparseTypes(TestCase):
+
+    def test_key_value(self):
+        """Do we split key=value pairs at the first equals sign?"""
+        self.assertEqual(key_value('court_id=ca1'), ('court_id', 'ca1'))
+        self.assertEqual(key_value('q=a=b'), ('q', 'a=b'))
+        self.assertEqual(key_value('court_id='), ('court_id', ''))
+
+    def test_key_value_rejects_bad_pairs(self):
+        """Do we reject strings without a key or an equals sign?"""
+        for s in ('court_id', '=ca1', ''):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                key_value(s)
+
+
+@override_settings(DEVELOPMENT=False)
+class TestQuerysetGenerators(TestCase):
+    """Test the generators that page through querysets by pk"""
+    fixtures = ['test_court.json', 'judge_judy.json',
+                'test_objects_search.json']
+
+    def test_queryset_generator(self):
+        """Do we get every item once, in pk order, whatever the chunksize?"""
+        for chunksize in (1, 2, 3, 4, 6, 10):
+            pks = [o.pk for o in queryset_generator(Opinion.objects.all(),
+                                                    chunksize=chunksize)]
+            self.assertEqual(pks, [1, 2, 3, 4, 5, 6])
+
+    def test_queryset_generator_stops_after_last_chunk(self):
+        """Do we stop at the first short chunk, even an empty one?"""
+        with self.assertNumQueries(1):
+            self.assertEqual(list(queryset_generator(
+                Opinion.objects.filter(pk__gt=100))), [])
+        with self.assertNumQueries(2):
+            # Six items in chunks of four.
+            list(queryset_generator(Opinion.objects.all(), chunksize=4))
+        with self.assertNumQueries(3):
+            # Six items in chunks of three, so the last chunk is empty.
+            list(queryset_generator(Opinion.objects.all(), chunksize=3))
+
+    def test_queryset_generator_keeps_filters(self):
+        """Is the filter applied to every chunk, not just the first?"""
+        qs = Opinion.objects.filter(cluster_id=1)
+        pks = [o.pk for o in queryset_generator(qs, chunksize=2)]
+        self.assertEqual(pks, [1, 4, 5, 6])
+
+    def test_queryset_generator_keeps_prefetches(self):
+        """Are prefetches done once per chunk, rather than once per item?"""
+        qs = OpinionCluster.objects.prefetch_related('sub_opinions')
+        with self.assertNumQueries(4):
+            # Two chunks, each with one query for its prefetch.
+            sub_opinions = dict(
+                (cluster.pk, sorted(o.pk for o in cluster.sub_opinions.all()))
+                for cluster in queryset_generator(qs, chunksize=2)
+            )
+        self.assertEqual(sub_opinions, {1: [1, 4, 5, 6], 2: [2], 3: [3]})
+
+    def test_pk_chunk_generator(self):
+        """Do we get every pk once, in pk order, in chunks of chunksize?"""
+        qs = Opinion.objects.all()
+        self.assertEqual(list(pk_chunk_generator(qs, chunksize=2)),
+                         [[1, 2], [3, 4], [5, 6]])
+        self.assertEqual(list(pk_chunk_generator(qs, chunksize=4)),
+                         [[1, 2, 3, 4], [5, 6]])
+        self.assertEqual(list(pk_chunk_generator(qs, chunksize=10)),
+                         [[1, 2, 3, 4, 5, 6]])
+
+    def test_pk_chunk_generator_edge_cases(self):
+        """Do empty and filtered querysets work?"""
+        self.assertEqual(
+            list(pk_chunk_generator(Opinion.objects.filter(pk__gt=100))), [])
+        self.assertEqual(
+            list(pk_chunk_generator(Opinion.objects.filter(cluster_id=1),
+                                    chunksize=3)),
+            [[1, 4, 5], [6]],
+        )
+
+
+class TestPrefetchingGenerator(TransactionTestCase):
+    """Test prefetching_generator outside of a transaction, where it fetches
+    items in a background thread.
+    """
+    fixtures = ['test_court.json', 'judge_judy.json',
+                'test_objects_search.json']
+
+    def test_runs_in_a_thread(self):
+        """Are the items produced on a thread other than the caller's?"""
+        threads = []
+
+        def items():
+            threads.append(threading.current_thread())
+            yield 1
+
+        self.assertEqual(list(prefetching_generator(items())), [1])
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_stopping_early_stops_the_thread(self):
+        """If the caller stops before the end, does the thread exit rather
+        than block on a full queue forever?
+        """
+        threads = []
+
+        def endless_items():
+            threads.append(threading.current_thread())
+            i = 0
+            while True:
+                yield i
+                i += 1
+
+        items = prefetching_generator(endless_items(), chunksize=1,
+                                      max_chunks=1)
+        self.assertEqual(next(items), 0)
+        items.close()
+        threads[0].join(timeout=5)
+        self.assertFalse(threads[0].is_alive())
+
+    def test_yields_every_item_in_order(self):
+        """Do we get every item once, in order, across chunk boundaries?"""
+        items = list(prefetching_generator(iter(range(10)), chunksize=3))
+        self.assertEqual(items, range(10))
+
+    def test_querysets(self):
+        """Can the thread read from the database on its own connection?"""
+        pks = [o.pk for o in prefetching_generator(
+            queryset_generator(Opinion.objects.all()), chunksize=2)]
+        self.assertEqual(pks, [1, 2, 3, 4, 5, 6])
+
+    def test_producer_exceptions_are_raised(self):
+        """If getting an item raises, do we raise it in the caller after
+        yielding the items that came before it?
+        """
+        def broken_items():
+            yield 1
+            yield 2
+            raise ValueError("Couldn't get the next item.")
+
+        items = []
+        with self.assertRaises(ValueError):
+            for item in prefetching_generator(broken_items(), chunksize=1,
+                                              max_chunks=1):
+                items.append(item)
+        self.assertEqual(items, [1, 2])
+
+
 class TestMakeFQ(TestCase):
     def test_make_fq(self):
         test_pairs = (
@@ -1,21 +1,48 @@
-import ast
 import sys
+import time
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 
-from celery.task.sets import TaskSet
+from celery import group
+from celery.result import ResultSet
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from cl.audio.models import Audio
-from cl.lib.argparse_types import valid_date_time, valid_obj_type
-from cl.lib.db_tools import queryset_generator
+from cl.lib.argparse_types import key_value, valid_date_time, valid_obj_type
+from cl.lib.db_tools import (estimate_queryset_count, estimate_table_count,
+                             pk_chunk_generator, prefetching_generator)
 from cl.lib.scorched_utils import ExtraSolrInterface
 from cl.lib.timer import print_timing
-from cl.people_db.models import Person
+from cl.lib.utils import chunks
+from cl.people_db.models import Person, Position
 from cl.search.models import Opinion, RECAPDocument
 from cl.search.tasks import (delete_items, add_or_update_audio_files,
                              add_or_update_opinions, add_or_update_items,
                              add_or_update_people, add_or_update_recap_document)
 
+# The number of items to send to each indexing task.
+BUNDLE_SIZE = 1000
+
+# The number of pks to get from Postgres per query when listing the items to
+# index. Each chunk is a single round trip, so bigger is faster, at the cost of
+# holding more pks in memory.
+FETCH_SIZE = 5000
+
+# When the window of outstanding indexing tasks is full, the number of them to
+# check with the result backend at a time, oldest first. If none are done, we
+# wait POLL_INTERVAL seconds, doubling each time up to MAX_POLL_INTERVAL.
+POLL_SIZE = 8
+POLL_INTERVAL = 0.25
+MAX_POLL_INTERVAL = 2
+
+TASK_BY_MODEL = {
+    Audio: add_or_update_audio_files,
+    Opinion: add_or_update_opinions,
+    Person: add_or_update_people,
+    RECAPDocument: add_or_update_recap_document,
+}
+
 
 def proceed_with_deletion(out, count, noinput):
     """
@@ -73,6 +100,14 @@ class Command(BaseCommand):
                  'Solr URL, overriding the default value that\'s in the '
                  'settings, e.g., http://127.0.0.1:8983/solr/swap_core'
         )
+        parser.add_argument(
+            '--max-in-flight',
+            type=int,
+            help='When updating, the number of indexing tasks to keep queued '
+                 'at once. Defaults to the INDEXER_MAX_IN_FLIGHT setting. '
+                 'About twice the number of indexer worker processes keeps '
+                 'them all busy.'
+        )
         parser.add_argument(
             '--noinput',
             action='store_true',
@@ -114,7 +149,9 @@ class Command(BaseCommand):
             '--do-commit',
             action='store_true',
             default=False,
-            help='Performs a simple commit and nothing more.'
+            help='Performs a hard commit after any updates or deletions are '
+                 'completed. Those only make soft commits, if any, so use '
+                 'this to make changes durable.'
         )
 
         act_upon_group = parser.add_mutually_exclusive_group()
@@ -125,16 +162,20 @@ class Command(BaseCommand):
             help='Take action on everything in the database',
         )
         act_upon_group.add_argument(
-            '--query',
-            help='Take action on items fulfilling a query. Queries should be '
-                 'formatted as Python dicts such as: "{\'court_id\':\'haw\'}"'
+            '--query-field',
+            type=key_value,
+            action='append',
+            metavar='FIELD=VALUE',
+            help='Take action on items fulfilling a query. Give this once for '
+                 'each field to match, e.g.: --query-field court_id=haw'
         )
         act_upon_group.add_argument(
             '--items',
             type=int,
             nargs='*',
-            help='Take action on a list of items using a single '
-                 'Celery task'
+            help='Take action on a list of items. When updating, long '
+                 'lists are split into bundles that are indexed by a group '
+                 'of Celery tasks'
         )
         act_upon_group.add_argument(
             '--datetime',
@@ -147,6 +188,9 @@ class Command(BaseCommand):
         self.verbosity = int(options.get('verbosity', 1))
         self.options = options
         self.noinput = options['noinput']
+        if options.get('max_in_flight') is not None and \
+                options['max_in_flight'] < 1:
+            raise CommandError("--max-in-flight must be at least one.")
         if not self.options['optimize_everything']:
             self.solr_url = options['solr_url']
             self.si = ExtraSolrInterface(self.solr_url, mode='rw')
@@ -159,7 +203,7 @@ class Command(BaseCommand):
                 self.add_or_update_all()
             elif options.get('datetime'):
                 self.add_or_update_by_datetime(options['datetime'])
-            elif options.get('query'):
+            elif options.get('query_field'):
                 self.stderr.write("Updating by query not implemented.")
                 sys.exit(1)
             elif options.get('items'):
@@ -172,12 +216,17 @@ class Command(BaseCommand):
                 self.delete_all()
             elif options.get('datetime'):
                 self.delete_by_datetime(options['datetime'])
-            elif options.get('query'):
-                self.delete_by_query(options['query'])
+            elif options.get('query_field'):
+                query_dict = dict(options['query_field'])
+                if len(query_dict) < len(options['query_field']):
+                    raise CommandError("Each field can only be given once "
+                                       "with --query-field.")
+                self.delete_by_query(query_dict)
             elif options.get('items'):
                 self.delete(*options['items'])
 
         if options.get('do_commit'):
+            # The only hard commit we make. Everything else is soft.
             self.si.commit()
 
         if options.get('optimize'):
@@ -194,44 +243,106 @@ class Command(BaseCommand):
                               'index.\n')
             sys.exit(1)
 
-    def _chunk_queryset_into_tasks(self, items, count, chunksize=50,
-                                   bundle_size=250):
-        """Chunks the queryset passed in, and dispatches it to Celery for
-        adding to the index.
-
-        Potential performance improvements:
-         - Postgres is quiescent when Solr is popping tasks from Celery,
-           instead, it should be fetching the next 1,000
+    def _chunk_queryset_into_tasks(self, items, count=None, max_in_flight=None,
+                                   bundle_size=BUNDLE_SIZE):
+        """Chunks the pks passed in, and dispatches them to Celery for adding
+        to the index.
+
+        Each subtask receives a bundle of bundle_size pks, loads the items,
+        and sends them to Solr in a few large update requests. Sending pks
+        rather than objects keeps the messages small and lets the subtasks
+        use JSON instead of pickle. No commits are made here; use
+        --do-commit to make the changes visible once everything is indexed.
+
+        Rather than waiting for batches of subtasks to finish, we keep up to
+        max_in_flight subtasks outstanding (by default, the
+        INDEXER_MAX_IN_FLIGHT setting). When the window is full, we check
+        the subtasks a few at a time, in turn, and send the next bundle as
+        soon as any of them is done, so one slow bundle doesn't hold up the
+        rest. This keeps the workers busy without flooding the broker or the
+        result backend. The only barrier is at the very end, when we wait for
+        everything to finish.
+
+        The pks are fetched from the database in a background thread, so
+        Postgres is working on the next bundles while we wait for Celery.
+
+        Bundles take a while to index, so the workers consuming them should
+        not reserve extra tasks. This requires CELERYD_PREFETCH_MULTIPLIER = 1
+        (see settings), late acks on add_or_update_items, and workers started
+        with -Ofair. In production, the subtasks are routed to the indexer
+        queue, so a worker must be consuming it (see scripts/etc/celeryd).
+
+        count is only used for the progress meter, so an estimate is fine. If
+        it's None, only the number of items processed so far is shown.
         """
+        if max_in_flight is None:
+            max_in_flight = settings.INDEXER_MAX_IN_FLIGHT
         processed_count = 0
-        subtasks = []
+        in_flight = []
         item_bundle = []
-        for item in items:
-            last_item = (count == processed_count + 1)
+
+        model_label = '%s.%s' % (self.type._meta.app_label,
+                                 self.type._meta.object_name)
+
+        def send_bundle(bundle):
+            in_flight.append(add_or_update_items.apply_async(
+                args=(bundle, model_label, self.solr_url),
+            ))
+            poll_interval = POLL_INTERVAL
+            while len(in_flight) >= max_in_flight:
+                checked = in_flight[:POLL_SIZE]
+                finished = [r for r in checked if r.ready()]
+                # Move the unfinished ones to the back, so the next poll
+                # checks others.
+                in_flight[:] = in_flight[POLL_SIZE:] + [
+                    r for r in checked if r not in finished
+                ]
+                if not finished:
+                    time.sleep(poll_interval)
+                    poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+                for result in finished:
+                    # Raise any errors from the subtask.
+                    result.get()
+
+        def print_progress():
+            if count is None:
+                sys.stdout.write("\rProcessed {}".format(processed_count))
+            else:
+                sys.stdout.write("\rProcessed {}/~{} ({:.0%})".format(
+                    processed_count,
+                    count,
+                    processed_count * 1.0 / max(count, processed_count, 1),
+                ))
+            sys.stdout.flush()
+
+        # Update the progress meter about a thousand times per run, or once
+        # per bundle if we don't know how many items there are, but not once
+        # per item.
+        if count is None:
+            progress_interval = bundle_size
+        else:
+            progress_interval = max(1, count // 1000)
+        items = prefetching_generator(items, chunksize=bundle_size,
+                                      max_chunks=max_in_flight)
+        for pk in items:
             if self.verbosity >= 2:
-                self.stdout.write('Indexing item %s' % item.pk)
-
-            item_bundle.append(item)
-            if (len(item_bundle) >= bundle_size) or last_item:
-                # Every bundle_size documents we create a subtask
-                subtasks.append(
-                    add_or_update_items.subtask((item_bundle, self.solr_url))
-                )
+                self.stdout.write('Indexing item %s' % pk)
+
+            item_bundle.append(pk)
+            if len(item_bundle) >= bundle_size:
+                # Every bundle_size documents we send a subtask to Celery
+                send_bundle(item_bundle)
                 item_bundle = []
             processed_count += 1
 
-            if (len(subtasks) >= chunksize) or last_item:
-                # Every chunksize items, we send the subtasks for processing
-                job = TaskSet(tasks=subtasks)
-                job.apply_async().join()
-                subtasks = []
+            if processed_count % progress_interval == 0:
+                print_progress()
 
-            sys.stdout.write("\rProcessed {}/{} ({:.0%})".format(
-                processed_count,
-                count,
-                processed_count * 1.0 / count,
-            ))
-            self.stdout.flush()
+        if item_bundle:
+            send_bundle(item_bundle)
+        # Wait for the stragglers.
+        ResultSet(in_flight).join()
+        print_progress()
         self.stdout.write('\n')
 
     @print_timing
@@ -254,7 +365,7 @@ class Command(BaseCommand):
             self.stdout.write('  Marking all items as deleted...\n')
             self.si.delete_all()
             self.stdout.write('  Committing the deletion...\n')
-            self.si.commit()
+            self.si.commit(softCommit=True)
             self.stdout.write('\nDone. The index located at: %s\n'
                               'is now empty.\n' % self.solr_url)
 
@@ -263,32 +374,76 @@ class Command(BaseCommand):
         """
         Given a datetime, deletes all items in the index newer than that time.
 
-        Relies on the items still being in the database.
+        Relies on the items still being in the database. Items are deleted
+        in batches so that no single request to Solr gets too big.
         """
-        qs = self.type.objects.filter(
-            date_created__gt=dt
-        ).values_list(
-            'pk',
-            flat=True,
-        )
+        qs = self.type.objects.filter(date_created__gt=dt)
         count = qs.count()
         if proceed_with_deletion(self.stdout, count, self.noinput):
             self.stdout.write("Deleting all item(s) newer than %s\n" % dt)
-            self.si.delete(list(qs))
-            self.si.commit()
+            self._delete_in_batches(pk_chunk_generator(qs), count)
+
+    def _delete_in_batches(self, pk_chunks, count, commit_each=False):
+        """Deletes each chunk of pks from the index in its own request, then
+        soft commits the deletions.
+
+        If commit_each is True, each chunk is soft committed before the next
+        one is requested instead, so that the deleted items no longer match
+        the queries made by a chunk generator that reads from the index.
+        """
+        deleted_count = 0
+        for pks in pk_chunks:
+            self.si.delete_by_ids(pks)
+            if commit_each:
+                self.si.commit(softCommit=True)
+            deleted_count += len(pks)
+            sys.stdout.write("\rDeleted {}/{} ({:.0%})".format(
+                deleted_count,
+                count,
+                deleted_count * 1.0 / max(count, deleted_count, 1),
+            ))
+            sys.stdout.flush()
+        self.stdout.write('\n')
+        if not commit_each:
+            self.si.commit(softCommit=True)
+
+    def _solr_id_chunk_generator(self, query_dict, chunksize=10000):
+        """Yield lists of up to chunksize ids of the items in the index that
+        match query_dict.
+
+        Every chunk must be deleted and committed before the next is
+        requested, since each request asks for the first chunksize matches.
+        This avoids paging deeper and deeper into the results.
+        """
+        q = self.si.query(self.si.Q(**query_dict)).field_limit('id').paginate(
+            rows=chunksize,
+        )
+        last_ids = None
+        while True:
+            ids = [doc['id'] for doc in q.execute()]
+            if not ids:
+                return
+            if ids == last_ids:
+                raise CommandError("Items in the index were not deleted: %s" %
+                                   ids[:10])
+            yield ids
+            last_ids = ids
 
     @print_timing
-    def delete_by_query(self, query):
+    def delete_by_query(self, query_dict):
         """
-        Given a query, deletes all the items that match that query.
+        Given a dict of fields and values, deletes all the items that match.
+
+        Rather than having Solr delete everything in a single deleteByQuery,
+        which blocks other updates until it's done, the ids of the matching
+        items are deleted in batches.
         """
-        query_dict = ast.literal_eval(query)
         count = self.si.query(self.si.Q(**query_dict)).count()
         if proceed_with_deletion(self.stdout, count, self.noinput):
             self.stdout.write("Deleting all item(s) that match the query: "
-                              "%s\n" % query)
-            self.si.delete(queries=self.si.Q(**query_dict))
-            self.si.commit()
+                              "%s\n" % query_dict)
+            self._delete_in_batches(self._solr_id_chunk_generator(query_dict),
+                                    count, commit_each=True)
 
     @print_timing
     def add_or_update(self, *items):
@@ -297,26 +452,30 @@ class Command(BaseCommand):
         in the index.
         """
         self.stdout.write("Adding or updating item(s): %s\n" % list(items))
-        # Use Celery to add or update the item asynchronously
-        if self.type == Opinion:
-            add_or_update_opinions.delay(items)
-        elif self.type == Audio:
-            add_or_update_audio_files.delay(items)
-        elif self.type == Person:
-            add_or_update_people.delay(items)
-        elif self.type == RECAPDocument:
-            add_or_update_recap_document.delay(items)
+        # Use Celery to add or update the item asynchronously, splitting big
+        # lists up so several workers can share them.
+        task = TASK_BY_MODEL[self.type]
+        if len(items) > BUNDLE_SIZE:
+            group(task.s(chunk) for chunk in
+                  chunks(items, BUNDLE_SIZE)).apply_async()
+        else:
+            task.delay(items)
 
     @print_timing
     def add_or_update_by_datetime(self, dt):
         """
         Given a datetime, adds or updates all items newer than that time.
+
+        Recent items are often newer than the planner's statistics, which
+        makes its estimate of how many there are useless, and counting them
+        would cost another query, so no total is shown in the progress meter.
         """
         self.stdout.write("Adding or updating items(s) newer than %s\n" % dt)
         qs = self.type.objects.filter(date_created__gte=dt)
-        items = queryset_generator(qs, chunksize=5000)
-        count = qs.count()
-        self._chunk_queryset_into_tasks(items, count)
+        items = chain.from_iterable(pk_chunk_generator(qs,
+                                                       chunksize=FETCH_SIZE))
+        self._chunk_queryset_into_tasks(
+            items, max_in_flight=self.options.get('max_in_flight'))
 
     @print_timing
     def add_or_update_all(self):
@@ -325,83 +484,26 @@ class Command(BaseCommand):
         an empty index or an existing one.
 
         If run on an existing index, existing items will be updated.
+
+        Only the pks of the items are read here, FETCH_SIZE at a time. The
+        items themselves are loaded by the Celery tasks that index them.
         """
         self.stdout.write("Adding or updating all items...\n")
         if self.type == Person:
-            q = self.type.objects.filter(
-                is_alias_of=None
-            ).prefetch_related(
-                'positions',
-                'positions__predecessor',
-                'positions__supervisor',
-                'positions__appointer',
-                'positions__court',
-                'political_affiliations',
-                'aba_ratings',
-                'educations__school',
-                'aliases',
-                'race',
-            )
             # Filter out non-judges -- they don't get searched.
-            q = [item for item in q if item.is_judge]
-            count = len(q)
-        elif self.type == RECAPDocument:
-            q = self.type.objects.all().prefetch_related(
-                # IDs
-                'docket_entry__pk',
-                'docket_entry__docket__pk',
-                'docket_entry__docket__court__pk',
-                'docket_entry__docket__assigned_to__pk',
-                'docket_entry__docket__referred_to__pk',
-
-                # Docket Entry
-                'docket_entry__description',
-                'docket_entry__entry_number',
-                'docket_entry__date_filed',
-
-                # Docket
-                'docket_entry__docket__date_argued',
-                'docket_entry__docket__date_filed',
-                'docket_entry__docket__date_terminated',
-                'docket_entry__docket__docket_number',
-                'docket_entry__docket__case_name_short',
-                'docket_entry__docket__case_name',
-                'docket_entry__docket__case_name_full',
-                'docket_entry__docket__nature_of_suit',
-                'docket_entry__docket__cause',
-                'docket_entry__docket__jury_demand',
-                'docket_entry__docket__jurisdiction_type',
-                'docket_entry__docket__slug',
-
-                # Judges
-                'docket_entry__docket__assigned_to__name_first',
-                'docket_entry__docket__assigned_to__name_middle',
-                'docket_entry__docket__assigned_to__name_last',
-                'docket_entry__docket__assigned_to__name_suffix',
-                'docket_entry__docket__assigned_to_str',
-                'docket_entry__docket__referred_to__name_first',
-                'docket_entry__docket__referred_to__name_middle',
-                'docket_entry__docket__referred_to__name_last',
-                'docket_entry__docket__referred_to__name_suffix',
-                'docket_entry__docket__referred_to_str',
-
-                # Court
-                'docket_entry__docket__court__full_name',
-                'docket_entry__docket__court__citation_string',
-            )
-            count = q.count()
-            q = queryset_generator(
-                q,
-                chunksize=5000,
-            )
+            judge_types = [k for k, v in Position.POSITION_TYPE_GROUPS.items()
+                           if v == 'Judge']
+            q = self.type.objects.filter(
+                is_alias_of=None,
+                positions__position_type__in=judge_types,
+            ).distinct()
+            count = estimate_queryset_count(q)
         else:
             q = self.type.objects.all()
-            count = q.count()
-            q = queryset_generator(
-                q,
-                chunksize=5000,
-            )
-        self._chunk_queryset_into_tasks(q, count)
+            count = estimate_table_count(self.type)
+        q = chain.from_iterable(pk_chunk_generator(q, chunksize=FETCH_SIZE))
+        self._chunk_queryset_into_tasks(
+            q, count, max_in_flight=self.options.get('max_in_flight'))
 
     @print_timing
     def optimize(self):
@@ -415,15 +517,30 @@ class Command(BaseCommand):
 
     @print_timing
     def optimize_everything(self):
-        """Run the optimize command on all indexes."""
+        """Run the optimize command on all indexes.
+
+        The indexes are independent and optimizing them is mostly a matter of
+        waiting on Solr, so they are all optimized at once. Each index is
+        listed as it finishes.
+        """
         urls = settings.SOLR_URLS.values()
         self.stdout.write("Found %s indexes. Optimizing...\n" % len(urls))
-        for url in urls:
-            self.stdout.write(" - {url}\n".format(url=url))
+
+        def optimize_url(url):
             try:
                 si = ExtraSolrInterface(url)
             except EnvironmentError:
-                self.stderr.write("   Couldn't load schema!")
-                continue
+                return url, False
             si.optimize()
+            return url, True
+
+        pool = ThreadPool(max(len(urls), 1))
+        try:
+            for url, optimized in pool.imap_unordered(optimize_url, urls):
+                self.stdout.write(" - {url}\n".format(url=url))
+                if not optimized:
+                    self.stderr.write("   Couldn't load schema!")
+        finally:
+            pool.close()
+            pool.join()
         self.stdout.write('Done.\n')
@@ -1,42 +1,178 @@
+import math
 import scorched
 import socket
 
+from celery.signals import worker_process_init
+from django.apps import apps
 from django.conf import settings
+from django.db.models import Prefetch
+from requests.exceptions import RequestException
+from requests.packages.urllib3.util.retry import Retry
 
 from cl.audio.models import Audio
 from cl.celery import app
+from cl.lib.scorched_utils import ExtraSolrInterface
 from cl.lib.search_index_utils import InvalidDocumentError
 from cl.lib.sunburnt import SolrError
 from cl.people_db.models import Person
 from cl.search.models import Opinion, OpinionCluster, RECAPDocument
 
 
-@app.task
-def add_or_update_items(items, solr_url=settings.SOLR_OPINION_URL):
-    """Adds an item to a solr index.
-
-    This function is for use with the update_index command. It's slightly
-    different than the commands below because it expects a Django object,
-    rather than a primary key. This rejects the standard Celery advice about
-    not passing objects around, but thread safety shouldn't be an issue since
-    this is only used by the update_index command, and we want to get the
-    objects in the task, not in its caller.
+# Each worker process keeps one Solr interface per URL, so that indexing tasks
+# reuse its schema and its pooled connections instead of setting up their own.
+solr_interfaces = {}
+
+
+@worker_process_init.connect
+def reset_solr_interfaces(**kwargs):
+    """Don't share connections with the parent of a new worker process."""
+    solr_interfaces.clear()
+
+
+def get_solr_interface(solr_url):
+    """Get this process's Solr interface for solr_url, creating it if needed.
+
+    Failed connections are retried a few times with a short backoff before
+    an error is raised, so that a brief hiccup in Solr doesn't fail a bundle.
+    Once those retries run out, add_or_update_items retries the whole bundle
+    after two minutes.
     """
-    si = scorched.SolrInterface(solr_url, mode='w')
-    if hasattr(items, "items") or not hasattr(items, "__iter__"):
-        # If it's a dict or a single item make it a list
-        items = [items]
+    si = solr_interfaces.get(solr_url)
+    if si is None:
+        si = ExtraSolrInterface(
+            solr_url,
+            mode='w',
+            max_retries=Retry(total=5, backoff_factor=0.5),
+        )
+        solr_interfaces[solr_url] = si
+    return si
+
+
+def get_index_queryset(model):
+    """Get a queryset for model that fetches everything its as_search_dict
+    method needs in as few queries as possible.
+
+    Models without related objects to fetch get a plain queryset.
+    """
+    if model == Person:
+        return Person.objects.prefetch_related(
+            'positions',
+            'positions__predecessor',
+            'positions__supervisor',
+            'positions__appointer',
+            'positions__court',
+            'political_affiliations',
+            'aba_ratings',
+            'educations__school',
+            'aliases',
+            'race',
+        )
+    elif model == RECAPDocument:
+        # Everything as_search_dict needs hangs off of these relations, so get
+        # it in the same query as the documents themselves, loading only the
+        # columns that it uses.
+        return RECAPDocument.objects.select_related(
+            'docket_entry__docket__court',
+            'docket_entry__docket__assigned_to',
+            'docket_entry__docket__referred_to',
+        ).only(
+            # RECAPDocument
+            'description',
+            'document_type',
+            'document_number',
+            'attachment_number',
+            'is_available',
+            'page_count',
+            'filepath_local',
+            'plain_text',
+
+            # Docket Entry
+            'docket_entry__description',
+            'docket_entry__entry_number',
+            'docket_entry__date_filed',
+
+            # Docket
+            'docket_entry__docket__date_argued',
+            'docket_entry__docket__date_filed',
+            'docket_entry__docket__date_terminated',
+            'docket_entry__docket__docket_number',
+            'docket_entry__docket__case_name_short',
+            'docket_entry__docket__case_name',
+            'docket_entry__docket__case_name_full',
+            'docket_entry__docket__nature_of_suit',
+            'docket_entry__docket__cause',
+            'docket_entry__docket__jury_demand',
+            'docket_entry__docket__jurisdiction_type',
+            'docket_entry__docket__slug',
+
+            # Judges
+            'docket_entry__docket__assigned_to__name_first',
+            'docket_entry__docket__assigned_to__name_middle',
+            'docket_entry__docket__assigned_to__name_last',
+            'docket_entry__docket__assigned_to__name_suffix',
+            'docket_entry__docket__assigned_to_str',
+            'docket_entry__docket__referred_to__name_first',
+            'docket_entry__docket__referred_to__name_middle',
+            'docket_entry__docket__referred_to__name_last',
+            'docket_entry__docket__referred_to__name_suffix',
+            'docket_entry__docket__referred_to_str',
+
+            # Court
+            'docket_entry__docket__court__full_name',
+            'docket_entry__docket__court__citation_string',
+        )
+    elif model == Opinion:
+        # Only the pks of cited and sibling opinions are indexed, so don't
+        # load their text.
+        return Opinion.objects.select_related(
+            'cluster__docket__court',
+            'author',
+        ).prefetch_related(
+            Prefetch('opinions_cited', queryset=Opinion.objects.only('pk')),
+            Prefetch('cluster__sub_opinions',
+                     queryset=Opinion.objects.only('pk', 'cluster')),
+            'joined_by',
+            'cluster__panel',
+            'cluster__non_participating_judges',
+        )
+    elif model == Audio:
+        return Audio.objects.select_related(
+            'docket__court',
+        ).prefetch_related(
+            'panel',
+        )
+    return model.objects.all()
+
+
+@app.task(acks_late=True, serializer='json')
+def add_or_update_items(item_pks, model_label,
+                        solr_url=settings.SOLR_OPINION_URL):
+    """Adds a bundle of items to a solr index.
+
+    This function is for use with the update_index command. It takes the pks
+    of the items and the label of their model (e.g., "search.Opinion"), and
+    loads the items itself, using get_index_queryset to do so in a handful of
+    queries. Passing pks instead of objects keeps the messages small enough
+    to send as JSON.
+
+    The bundle is split into a few large chunks that are sent to Solr
+    concurrently, rather than one chunk of 100 at a time. Nothing is committed
+    here; callers are expected to commit once their bulk work is complete.
+
+    The task is acknowledged only once it completes, so that a bundle isn't
+    lost if its worker dies, and so that, with a prefetch multiplier of one,
+    workers don't reserve bundles while they're still busy with another.
+
+    The Solr interface is shared by all the tasks a worker process runs.
+    """
+    si = get_solr_interface(solr_url)
+    items = get_index_queryset(apps.get_model(model_label)).filter(
+        pk__in=item_pks,
+    )
     search_item_list = []
     for item in items:
         try:
-            if type(item) == Audio:
-                search_item_list.append(item.as_search_dict())
-            elif type(item) == Opinion:
-                search_item_list.append(item.as_search_dict())
-            elif type(item) == RECAPDocument:
-                search_item_list.append(item.as_search_dict())
-            elif type(item) == Person:
-                search_item_list.append(item.as_search_dict())
+            search_item_list.append(item.as_search_dict())
         except AttributeError as e:
             print "AttributeError trying to add: %s\n  %s" % (item, e)
         except ValueError as e:
@@ -44,9 +180,14 @@ def add_or_update_items(items, solr_url=settings.SOLR_OPINION_URL):
         except InvalidDocumentError:
             print "Unable to parse: %s" % item
 
+    if not search_item_list:
+        return
+
     try:
-        si.add(search_item_list)
-    except socket.error, exc:
+        chunk = int(math.ceil(len(search_item_list) /
+                              float(si.max_connections)))
+        si.add_concurrently(search_item_list, chunk=chunk)
+    except (socket.error, RequestException), exc:
         add_or_update_items.retry(exc=exc, countdown=120)
 
 
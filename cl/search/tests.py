@@ -6,10 +6,12 @@ import os
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest
 from django.test import RequestFactory
 from django.test import TestCase, override_settings
+from django.utils.timezone import utc
 from lxml import etree, html
 from rest_framework.status import HTTP_200_OK
 from timeout_decorator import timeout_decorator
@@ -20,6 +22,7 @@ from cl.lib.test_helpers import SolrTestCase, IndexedSolrTestCase, \
 from cl.search.feeds import JurisdictionFeed
 from cl.search.management.commands.cl_calculate_pagerank import Command
 from cl.search.models import Court, Docket, Opinion, OpinionCluster
+from cl.search.tasks import get_index_queryset
 from cl.search.views import do_search
 from cl.tests.base import BaseSeleniumTest
 
@@ -127,6 +130,109 @@ class UpdateIndexCommandTest(SolrTestCase):
                 ),
         )
 
+        # Delete one of them by querying a field
+        args = list(self.args)  # Make a copy of the list.
+        args.extend([
+            '--solr-url',
+            'http://127.0.0.1:8983/solr/%s' % self.core_name_opinion,
+            '--delete',
+            '--query-field', 'id=1',
+            '--do-commit',
+        ])
+        call_command('cl_update_index', *args)
+        results = self.si_opinion.raw_query(**{'q': '*'}).execute()
+        actual_count = self._get_result_count(results)
+        expected_count = 2
+        self.assertEqual(
+            actual_count,
+            expected_count,
+            msg="Did not get the expected number of counts after deleting "
+                "by query.\n"
+                "\tGot:\t %s\n\tExpected:\t%s" % (
+                    actual_count,
+                    expected_count,
+                ),
+        )
+
+    def test_deleting_by_datetime(self):
+        """Do we delete only the items created after the given time?"""
+        # Make half the opinions newer than the rest.
+        Opinion.objects.filter(pk__in=[4, 5, 6]).update(
+            date_created=datetime.datetime(2016, 1, 1, tzinfo=utc),
+        )
+        args = list(self.args)  # Make a copy of the list.
+        args.extend([
+            '--solr-url',
+            'http://127.0.0.1:8983/solr/%s' % self.core_name_opinion,
+            '--update',
+            '--everything',
+            '--do-commit',
+        ])
+        call_command('cl_update_index', *args)
+
+        args = list(self.args)  # Make a copy of the list.
+        args.extend([
+            '--solr-url',
+            'http://127.0.0.1:8983/solr/%s' % self.core_name_opinion,
+            '--delete',
+            '--datetime', '2015-12-01',
+            '--do-commit',
+        ])
+        call_command('cl_update_index', *args)
+        results = self.si_opinion.raw_query(**{'q': '*'}).execute()
+        actual_count = self._get_result_count(results)
+        expected_count = 3
+        self.assertEqual(
+            actual_count,
+            expected_count,
+            msg="Did not get the expected number of counts after deleting "
+                "by datetime.\n"
+                "\tGot:\t %s\n\tExpected:\t%s" % (
+                    actual_count,
+                    expected_count,
+                ),
+        )
+        results = self.si_opinion.raw_query(
+            **{'q': 'id:(1 OR 2 OR 3)'}).execute()
+        self.assertEqual(
+            self._get_result_count(results),
+            expected_count,
+            msg="Older items were deleted from the index.",
+        )
+
+    def test_deleting_by_query_rejects_repeated_fields(self):
+        """Do we refuse to delete by a query that gives a field twice?"""
+        args = list(self.args)  # Make a copy of the list.
+        args.extend([
+            '--solr-url',
+            'http://127.0.0.1:8983/solr/%s' % self.core_name_opinion,
+            '--delete',
+            '--query-field', 'id=1',
+            '--query-field', 'id=2',
+        ])
+        with self.assertRaises(CommandError):
+            call_command('cl_update_index', *args)
+
+
+class IndexQuerysetTest(TestCase):
+    fixtures = ['test_court.json', 'judge_judy.json',
+                'test_objects_search.json']
+
+    def test_opinion_index_queryset(self):
+        """Do opinions from the indexing queryset, with its select_related
+        and prefetches, give the same search dicts as plain ones?
+        """
+        def normalize(d):
+            # Related items aren't fetched in any particular order.
+            return dict((k, sorted(v) if isinstance(v, list) else v)
+                        for k, v in d.items())
+
+        for opinion in get_index_queryset(Opinion):
+            self.assertEqual(
+                normalize(opinion.as_search_dict()),
+                normalize(Opinion.objects.get(pk=opinion.pk).as_search_dict()),
+            )
+
 
 class ModelTest(TestCase):
     fixtures = ['test_court.json']
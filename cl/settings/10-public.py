@@ -181,6 +181,12 @@ else:
     CELERY_RESULT_BACKEND = 'redis://%s:%s/%s' % (REDIS_HOST, REDIS_PORT,
                                                   REDIS_DATABASES['CELERY'])
     CELERYD_CONCURRENCY = 20
+    # Indexing tasks spend their time waiting on Postgres and Solr, so they
+    # get their own queue and workers (see scripts/etc/celeryd), where they
+    # can run with high concurrency without starving other tasks.
+    CELERY_ROUTES = {
+        'cl.search.tasks.add_or_update_items': {'queue': 'indexer'},
+    }
     BROKER_POOL_LIMIT = 30
     BROKER_TRANSPORT_OPTIONS = {
         # This is the length of time a task will wait to be acknowledged by a
@@ -195,6 +201,17 @@ else:
 CELERY_DISABLE_RATE_LIMITS = True
 CELERY_SEND_TASK_ERROR_EMAILS = True
 
+# Many of our tasks (e.g., indexing bundles of items) take seconds or minutes.
+# Don't let a busy worker reserve extra tasks that idle workers could be doing.
+# Workers should also be started with -Ofair (see scripts/etc/celeryd).
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+# The default number of bundles cl_update_index keeps queued for the indexer
+# workers at once (see its --max-in-flight option). This doesn't configure the
+# workers. About twice the indexer node's concurrency (-c:indexer in
+# scripts/etc/celeryd) keeps each worker process busy.
+INDEXER_MAX_IN_FLIGHT = 80
+
 
 ####################
 # Cache & Sessions #